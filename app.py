@@ -3,21 +3,32 @@ import json
 import base64
 import asyncio
 import aiohttp
+import orjson
 import time
+import random
 import uuid
+import hashlib
+import shutil
+import zipfile
+import threading
+import multiprocessing
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from quart import Quart, Response, render_template, request, jsonify, send_file
 from werkzeug.utils import secure_filename
-from typing import List, Dict
+from typing import List, Dict, Optional
 import logging
 import fitz  # PyMuPDF
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
+app.config['CACHE_FOLDER'] = 'cache'
 
 DEFAULT_PROMPT = """你是一位内容架构专家。请分析图片中的内容，并执行：
 
@@ -47,55 +58,435 @@ DEFAULT_FORMAT_EXAMPLE = """## 第一章 概念
 
 CONFIG_FILE = 'prompt_config.json'
 
+_CFG_CACHE = {'mtime': 0, 'data': None}
+
 def load_prompt_config():
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {'prompt': DEFAULT_PROMPT, 'format_example': DEFAULT_FORMAT_EXAMPLE}
+    try:
+        st = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return {'prompt': DEFAULT_PROMPT, 'format_example': DEFAULT_FORMAT_EXAMPLE}
+    # 文件未修改时直接返回缓存，避免重复读盘和解析
+    if st.st_mtime_ns == _CFG_CACHE['mtime']:
+        return _CFG_CACHE['data']
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    _CFG_CACHE['mtime'] = st.st_mtime_ns
+    _CFG_CACHE['data'] = data
+    return data
 
 def save_prompt_config_to_file(config):
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=2)
+    _CFG_CACHE['mtime'] = 0
 
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
+# Quart默认60秒内必须收完请求体，放宽以容纳慢速网络下的50MB上传
+app.config['BODY_TIMEOUT'] = 300  # 秒
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['CACHE_FOLDER'], exist_ok=True)
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# 连接池上限，也是并发上限允许设置的最大值
+MAX_CONNECTIONS = 16
+_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """获取全局复用的HTTP会话（首次调用时在当前事件循环上创建）"""
+    global _SESSION, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        # 会话绑定创建时的事件循环，循环变化后需重新创建
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, ttl_dns_cache=300, keepalive_timeout=75)
+        )
+        _SESSION_LOOP = loop
+    return _SESSION
+
+
+async def close_session():
+    global _SESSION, _SESSION_LOOP
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+    _SESSION_LOOP = None
+
+
+IMAGE_MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg'}
+IMAGE_EXTENSIONS = frozenset(IMAGE_MIME_TYPES)
+
+
+DATA_URL_PREFIXES = {ext: f"data:{mime};base64,".encode('ascii') for ext, mime in IMAGE_MIME_TYPES.items()}
+
+
 def encode_image(image_path):
+    """读取图片并生成data URL，在bytes层面拼接前缀后只解码一次"""
+    prefix = DATA_URL_PREFIXES.get(os.path.splitext(image_path)[1].lower(), DATA_URL_PREFIXES['.png'])
     with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode()
+        data = f.read()
+    return (prefix + base64.b64encode(data)).decode('ascii')
+
+
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', '200'))
+# 渲染后图片长边的像素上限，超大页面按比例降低缩放倍数
+PDF_TARGET_PX = int(os.environ.get('PDF_TARGET_PX', '2048'))
+PDF_MAX_ZOOM = 2.0
+JPEG_QUALITY = 85
+
+
+class PdfTooLargeError(ValueError):
+    """PDF页数超过 PDF_MAX_PAGES"""
+
+
+def check_pdf_pages(pdf_path):
+    """返回PDF页数，超过上限时抛出 PdfTooLargeError"""
+    with fitz.open(pdf_path) as pdf_doc:
+        total_pages = len(pdf_doc)
+    if total_pages > PDF_MAX_PAGES:
+        raise PdfTooLargeError(f'PDF页数({total_pages})超过上限{PDF_MAX_PAGES}页')
+    return total_pages
+
+
+def page_zoom(rect):
+    return min(PDF_MAX_ZOOM, PDF_TARGET_PX / max(rect.width, rect.height, 1))
+
+
+def _render_page(pdf_path, page_num, padding, output_dir):
+    """渲染PDF单页为图片（在子进程中执行）"""
+    pdf_doc = fitz.open(pdf_path)
+    try:
+        page = pdf_doc[page_num]
+        zoom = page_zoom(page.rect)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        # 直接在内存中编码为JPEG，跳过PNG压缩和回读
+        jpeg_bytes = pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
+    finally:
+        pdf_doc.close()
+    img_name = f"page_{str(page_num + 1).zfill(padding)}.jpg"
+    img_path = os.path.join(output_dir, img_name)
+    with open(img_path, 'wb') as f:
+        f.write(jpeg_bytes)
+    return img_path
+
+
+RENDER_WORKERS = min(os.cpu_count() or 1, 6)
+_RENDER_POOL: Optional[ProcessPoolExecutor] = None
+_RENDER_POOL_LOCK = threading.Lock()
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    """获取全局复用的渲染进程池；使用forkserver启动，避免在多线程进程中fork"""
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is None:
+            _RENDER_POOL = ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+        return _RENDER_POOL
+
+
+def shutdown_render_pool():
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        if _RENDER_POOL is not None:
+            _RENDER_POOL.shutdown(wait=False, cancel_futures=True)
+        _RENDER_POOL = None
+
+
+def _discard_render_pool(pool):
+    """丢弃已损坏的进程池，下次调用 get_render_pool 时重建"""
+    global _RENDER_POOL
+    with _RENDER_POOL_LOCK:
+        # 只丢弃出错的那个池，其他线程可能已经换上了新池
+        if _RENDER_POOL is pool:
+            _RENDER_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
 
 
 def convert_pdf_to_images(pdf_path, output_dir):
     """将PDF转换为图片"""
-    images = []
-    pdf_doc = fitz.open(pdf_path)
-    total_pages = len(pdf_doc)
+    total_pages = check_pdf_pages(pdf_path)
     padding = len(str(total_pages))
-    for page_num in range(total_pages):
-        page = pdf_doc[page_num]
-        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img_name = f"page_{str(page_num + 1).zfill(padding)}.png"
-        img_path = os.path.join(output_dir, img_name)
-        pix.save(img_path)
+    render = partial(_render_page, pdf_path, padding=padding, output_dir=output_dir)
+    if total_pages <= 1 or RENDER_WORKERS <= 1:
+        return [render(page_num) for page_num in range(total_pages)]
+    # PyMuPDF渲染不能可靠地释放GIL，使用多进程并行
+    for attempt in range(2):
+        pool = get_render_pool()
+        try:
+            return list(pool.map(render, range(total_pages)))
+        except BrokenProcessPool:
+            # 子进程崩溃（如PDF异常或被OOM终止）后进程池永久不可用，重建后重试一次
+            _discard_render_pool(pool)
+            if attempt:
+                raise
+            logger.warning("渲染进程池已损坏，重建后重试")
+
+
+PDF_CACHE_MAX_ENTRIES = int(os.environ.get('PDF_CACHE_MAX_ENTRIES', '50'))
+# 渲染参数变化后旧缓存不再适用，参数写入缓存目录名
+PDF_CACHE_TAG = f"px{PDF_TARGET_PX}-z{PDF_MAX_ZOOM:g}-q{JPEG_QUALITY}"
+
+
+def remove_existing(path):
+    """删除已存在的文件；任务目录中的文件可能是缓存的硬链接，不能原地覆盖写"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def save_and_hash(file, filepath, chunk_size=1 << 20):
+    """边写入磁盘边计算SHA-256，返回文件内容的摘要"""
+    h = hashlib.sha256()
+    remove_existing(filepath)
+    with open(filepath, 'wb') as out:
+        while chunk := file.stream.read(chunk_size):
+            h.update(chunk)
+            out.write(chunk)
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst):
+    remove_existing(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _populate_pdf_cache(pdf_path, cache_dir):
+    # 先渲染到临时目录再原子重命名，避免并发上传读到不完整的缓存
+    tmp_dir = f"{cache_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    try:
+        for img_path in convert_pdf_to_images(pdf_path, tmp_dir):
+            os.chmod(img_path, 0o444)
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _link_cached_pages(cache_dir, prefix, output_dir):
+    images = []
+    for name in sorted(os.listdir(cache_dir)):
+        img_path = os.path.join(output_dir, f"{prefix}_{name}")
+        _link_or_copy(os.path.join(cache_dir, name), img_path)
         images.append(img_path)
-    pdf_doc.close()
     return images
 
 
+def evict_pdf_cache():
+    """只保留最近使用的 PDF_CACHE_MAX_ENTRIES 个缓存目录"""
+    cache_root = app.config['CACHE_FOLDER']
+    with os.scandir(cache_root) as it:
+        entries = [e for e in it if e.is_dir() and '.tmp-' not in e.name]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    for e in entries[PDF_CACHE_MAX_ENTRIES:]:
+        # 已链接到任务目录的图片不受影响
+        shutil.rmtree(e.path, ignore_errors=True)
+
+
+def convert_pdf_to_images_cached(pdf_path, digest, output_dir):
+    """按内容摘要缓存PDF渲染结果，相同PDF再次上传时直接链接已有图片"""
+    # 先检查页数，命中缓存时也不能绕过页数上限
+    check_pdf_pages(pdf_path)
+    cache_dir = os.path.join(app.config['CACHE_FOLDER'], f"{digest}-{PDF_CACHE_TAG}")
+    # 以PDF文件名作前缀，避免同一任务中多个PDF或同名图片相互覆盖
+    prefix = Path(pdf_path).stem
+    try:
+        images = _link_cached_pages(cache_dir, prefix, output_dir)
+        os.utime(cache_dir)
+        return images
+    except FileNotFoundError:
+        pass
+    _populate_pdf_cache(pdf_path, cache_dir)
+    images = _link_cached_pages(cache_dir, prefix, output_dir)
+    evict_pdf_cache()
+    return images
+
+
+MAX_CONCURRENCY = int(os.environ.get('QWEN_MAX_CONCURRENCY', '3'))
+if not 1 <= MAX_CONCURRENCY <= MAX_CONNECTIONS:
+    raise ValueError(f'QWEN_MAX_CONCURRENCY 必须在1到{MAX_CONNECTIONS}之间，当前为 {MAX_CONCURRENCY}')
+MAX_RPS = float(os.environ.get('QWEN_MAX_RPS', '10'))
+if MAX_RPS <= 0:
+    raise ValueError(f'QWEN_MAX_RPS 必须大于0，当前为 {MAX_RPS}')
+# 流式输出期间是否一直占用并发名额（关闭后首个事件到达即释放）
+HOLD_SLOT_WHILE_STREAMING = os.environ.get('QWEN_HOLD_SLOT_WHILE_STREAMING', '1').lower() not in ('0', 'false', 'no')
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+
+
+def _retry_after_seconds(resp: aiohttp.ClientResponse) -> Optional[float]:
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+async def _post_with_retry(session: aiohttp.ClientSession, url: str, **kwargs) -> aiohttp.ClientResponse:
+    """发送POST请求，对429/5xx和网络超时做指数退避重试；调用方负责释放返回的响应"""
+    for attempt in range(RETRY_ATTEMPTS):
+        last_attempt = attempt == RETRY_ATTEMPTS - 1
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.5)
+        try:
+            resp = await session.post(url, **kwargs)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            if last_attempt:
+                raise
+            logger.warning(f"请求失败，{delay:.1f}秒后重试: {e!r}")
+        else:
+            if resp.status not in RETRY_STATUSES or last_attempt:
+                return resp
+            retry_after = _retry_after_seconds(resp)
+            if retry_after is not None:
+                # 重试期间占用全局并发名额，服务端要求的等待时间也要设上限
+                delay = min(retry_after, RETRY_MAX_DELAY)
+            resp.release()
+            logger.warning(f"接口返回 {resp.status}，{delay:.1f}秒后重试")
+        await asyncio.sleep(delay)
+
+
+async def read_sse_stream(resp: aiohttp.ClientResponse):
+    """读取OpenAI兼容的SSE流，拼接增量内容并从末尾事件中取出token用量"""
+    parts = []
+    tokens = 0
+    done = False
+    async for raw in resp.content:
+        line = raw.strip()
+        if not line.startswith(b'data:'):
+            continue
+        data = line[5:].strip()
+        if data == b'[DONE]':
+            done = True
+            break
+        event = orjson.loads(data)
+        if 'error' in event:
+            raise RuntimeError(event['error'].get('message', str(event['error'])))
+        for choice in event.get('choices') or []:
+            delta = choice.get('delta') or {}
+            if delta.get('content'):
+                parts.append(delta['content'])
+        if event.get('usage'):
+            tokens = event['usage'].get('total_tokens', tokens)
+    if not done:
+        # 连接在[DONE]之前关闭说明输出不完整，按失败处理，避免写出截断的结果
+        raise RuntimeError('流式响应在[DONE]之前提前结束')
+    return ''.join(parts), tokens
+
+
+class TokenBucket:
+    """异步令牌桶限速器：每秒最多发放 rate 个令牌，突发上限为 capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError(f'rate 必须大于0，当前为 {rate}')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        while True:
+            # 只在锁内补充并检查令牌，等待放在锁外，避免持锁睡眠导致串行化
+            async with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class AdmissionController:
+    """可在运行时调整上限的并发控制器，调小上限后已在进行的请求自然结束"""
+
+    def __init__(self, max_active: int):
+        self._cond = asyncio.Condition()
+        self._active = 0
+        self._cmax = max_active
+
+    @property
+    def max_active(self) -> int:
+        return self._cmax
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self._cmax)
+            self._active += 1
+
+    async def release(self):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def set_max_active(self, max_active: int):
+        async with self._cond:
+            self._cmax = max_active
+            self._cond.notify_all()
+
+
+# 限速器和并发控制器为进程级全局对象，所有任务共享
+LIMITER = TokenBucket(MAX_RPS)
+ADMISSION = AdmissionController(MAX_CONCURRENCY)
+WRITER_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='writer')
+
+
+def write_markdown(md_file, result):
+    with open(md_file, 'w', encoding='utf-8') as f:
+        f.write(f"# {result['filename']}\n\n")
+        f.write(result['content'])
+
+
+def write_summary(summary_file, summary):
+    with open(summary_file, 'wb') as f:
+        f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+
+
 class QwenVLProcessor:
     def __init__(self, api_key: str, custom_prompt: str = None, format_example: str = None):
         self.api_key = api_key
         self.api_base = "https://dashscope.aliyuncs.com/compatible-mode/v1"
         self.model = "qwen-vl-plus"
-        self.semaphore = asyncio.Semaphore(3)
+        self.admission = ADMISSION
+        self.limiter = LIMITER
+        # 限制同时已编码、等待发送的图片数量，避免整批图片同时驻留内存
+        self.prefetch = asyncio.Semaphore(2 * self.admission.max_active)
+        self.writer_pool = WRITER_POOL
         
         if custom_prompt:
             if format_example:
@@ -104,108 +495,165 @@ class QwenVLProcessor:
                 self.system_prompt = custom_prompt
         else:
             self.system_prompt = DEFAULT_PROMPT
+        
+        # 请求头和消息中不变的部分只构建一次，各页共用
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        self._system_message = {"role": "system", "content": self.system_prompt}
+        self._user_text = {"type": "text", "text": "请提取并重构这张教育学框架图的内容："}
 
     async def process_single(self, image_path: str, session: aiohttp.ClientSession) -> Dict:
-        async with self.semaphore:
-            image_base64 = encode_image(image_path)
-            
-            payload = {
-                "model": self.model,
-                "messages": [
-                    {"role": "system", "content": self.system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "请提取并重构这张教育学框架图的内容："},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/png;base64,{image_base64}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "temperature": 0.3,
-                "max_tokens": 3000
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
+        async with self.prefetch:
+            # 在获取并发名额前于线程池中完成读取和编码，让磁盘I/O与进行中的请求重叠
             try:
-                async with session.post(
-                    f"{self.api_base}/chat/completions",
-                    headers=headers,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=120)
-                ) as resp:
-                    result = await resp.json()
+                loop = asyncio.get_running_loop()
+                image_url = await loop.run_in_executor(None, encode_image, image_path)
+            except Exception as e:
+                return {
+                    "filename": os.path.basename(image_path),
+                    "status": "error",
+                    "error": str(e)
+                }
+            return await self._request(image_path, image_url, session)
+
+    async def _request(self, image_path: str, image_url: str, session: aiohttp.ClientSession) -> Dict:
+        payload = {
+            "model": self.model,
+            "messages": [
+                self._system_message,
+                {
+                    "role": "user",
+                    "content": [
+                        self._user_text,
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                                "detail": "high"
+                            }
+                        }
+                    ]
+                }
+            ],
+            "temperature": 0.3,
+            "max_tokens": 3000,
+            "stream": True,
+            "stream_options": {"include_usage": True}
+        }
+        
+        await self.limiter.acquire()
+        await self.admission.acquire()
+        holding = True
+        try:
+            # 重试期间保持限速器和并发名额，避免429后集中重发
+            resp = await _post_with_retry(
+                session,
+                f"{self.api_base}/chat/completions",
+                headers=self._headers,
+                data=orjson.dumps(payload),
+                timeout=aiohttp.ClientTimeout(total=120)
+            )
+            async with resp:
+                if resp.status != 200 or resp.content_type != 'text/event-stream':
+                    body = await resp.read()
+                    try:
+                        result = orjson.loads(body)
+                    except orjson.JSONDecodeError:
+                        result = None
                     
-                    if 'choices' in result:
+                    # 服务端未按流式返回时，仍按普通JSON响应处理
+                    if resp.status == 200 and isinstance(result, dict) and 'choices' in result:
                         content = result['choices'][0]['message']['content']
-                        tokens = result.get('usage', {}).get('total_tokens', 0)
+                        tokens = (result.get('usage') or {}).get('total_tokens', 0)
                         return {
                             "filename": os.path.basename(image_path),
                             "status": "success",
                             "content": content,
                             "tokens": tokens
                         }
+                    
+                    if isinstance(result, dict) and isinstance(result.get('error'), dict):
+                        error_msg = result['error'].get('message', str(result))
+                    elif result is not None:
+                        error_msg = str(result)
                     else:
-                        error_msg = result.get('error', {}).get('message', str(result))
-                        return {
-                            "filename": os.path.basename(image_path),
-                            "status": "error",
-                            "error": error_msg
-                        }
-                        
-            except Exception as e:
+                        error_msg = body[:200].decode('utf-8', 'replace')
+                    if resp.status != 200:
+                        error_msg = f"HTTP {resp.status}: {error_msg}"
+                    return {
+                        "filename": os.path.basename(image_path),
+                        "status": "error",
+                        "error": error_msg
+                    }
+                
+                if not HOLD_SLOT_WHILE_STREAMING:
+                    # 流已建立，提前释放并发名额让其他页面开始请求
+                    await self.admission.release()
+                    holding = False
+                content, tokens = await read_sse_stream(resp)
                 return {
                     "filename": os.path.basename(image_path),
-                    "status": "error",
-                    "error": str(e)
+                    "status": "success",
+                    "content": content,
+                    "tokens": tokens
                 }
+                    
+        except Exception as e:
+            return {
+                "filename": os.path.basename(image_path),
+                "status": "error",
+                "error": str(e)
+            }
+        finally:
+            if holding:
+                await self.admission.release()
+
+    async def _process_and_write(self, image_path: str, session: aiohttp.ClientSession,
+                                 output_dir: str, write_futures: List[asyncio.Future]) -> Dict:
+        result = await self.process_single(image_path, session)
+        if result['status'] == 'success':
+            # 每页完成后立即交给写线程落盘，不阻塞事件循环
+            md_file = os.path.join(output_dir, f"{Path(result['filename']).stem}.md")
+            loop = asyncio.get_running_loop()
+            write_futures.append(loop.run_in_executor(self.writer_pool, write_markdown, md_file, result))
+        return result
 
     async def batch_process(self, file_paths: List[str], job_id: str):
         output_dir = os.path.join(app.config['OUTPUT_FOLDER'], job_id)
         os.makedirs(output_dir, exist_ok=True)
         
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.process_single(fp, session) for fp in file_paths]
-            results = await asyncio.gather(*tasks)
-            
-            for result in results:
-                if result['status'] == 'success':
-                    md_file = os.path.join(output_dir, f"{Path(result['filename']).stem}.md")
-                    with open(md_file, 'w', encoding='utf-8') as f:
-                        f.write(f"# {result['filename']}\n\n")
-                        f.write(result['content'])
-            
-            summary = {
-                "total": len(results),
-                "success": sum(1 for r in results if r['status'] == 'success'),
-                "failed": [r['filename'] for r in results if r['status'] == 'error'],
-                "results": results
-            }
-            
-            with open(os.path.join(output_dir, "summary.json"), 'w', encoding='utf-8') as f:
-                json.dump(summary, f, ensure_ascii=False, indent=2)
-            
-            return summary
+        session = await get_session()
+        write_futures = []
+        tasks = [self._process_and_write(fp, session, output_dir, write_futures) for fp in file_paths]
+        results = await asyncio.gather(*tasks)
+        await asyncio.gather(*write_futures)
+        
+        summary = {
+            "total": len(results),
+            "success": sum(1 for r in results if r['status'] == 'success'),
+            "failed": [r['filename'] for r in results if r['status'] == 'error'],
+            "results": results
+        }
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.writer_pool, write_summary, os.path.join(output_dir, "summary.json"), summary
+        )
+        
+        return summary
 
 
 @app.route('/api/config/prompt', methods=['GET'])
-def get_prompt_config():
+async def get_prompt_config():
     config = load_prompt_config()
     return jsonify(config)
 
 
 @app.route('/api/config/prompt', methods=['POST'])
-def save_prompt_config_api():
-    data = request.get_json()
+async def save_prompt_config_api():
+    data = await request.get_json()
     config = {
         'prompt': data.get('prompt', DEFAULT_PROMPT),
         'format_example': data.get('format_example', DEFAULT_FORMAT_EXAMPLE)
@@ -214,18 +662,36 @@ def save_prompt_config_api():
     return jsonify({'success': True})
 
 
+@app.route('/api/config/concurrency', methods=['GET'])
+async def get_concurrency_config():
+    return jsonify({'max_concurrency': ADMISSION.max_active, 'active': ADMISSION.active})
+
+
+@app.route('/api/config/concurrency', methods=['POST'])
+async def set_concurrency_config():
+    data = await request.get_json()
+    max_concurrency = data.get('max_concurrency') if data else None
+    if (not isinstance(max_concurrency, int) or isinstance(max_concurrency, bool)
+            or not 1 <= max_concurrency <= MAX_CONNECTIONS):
+        return jsonify({'error': f'max_concurrency 必须为1到{MAX_CONNECTIONS}之间的整数'}), 400
+    await ADMISSION.set_max_active(max_concurrency)
+    return jsonify({'success': True, 'max_concurrency': max_concurrency})
+
+
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
 
 @app.route('/api/upload', methods=['POST'])
-def upload_files():
-    if 'files' not in request.files:
+async def upload_files():
+    request_files = await request.files
+    form = await request.form
+    if 'files' not in request_files:
         return jsonify({'error': '没有选择文件'}), 400
     
-    files = request.files.getlist('files')
-    api_key = request.form.get('api_key', '').strip()
+    files = request_files.getlist('files')
+    api_key = form.get('api_key', '').strip()
     
     if not api_key:
         return jsonify({'error': '请输入API Key'}), 400
@@ -243,17 +709,24 @@ def upload_files():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             filepath = os.path.join(upload_dir, filename)
-            file.save(filepath)
             
             if filename.lower().endswith('.pdf'):
-                # 转换PDF为图片
+                # 转换PDF为图片，放到线程中等待进程池，不阻塞事件循环
                 try:
-                    pdf_images = convert_pdf_to_images(filepath, upload_dir)
+                    loop = asyncio.get_running_loop()
+                    digest = await loop.run_in_executor(None, save_and_hash, file, filepath)
+                    pdf_images = await loop.run_in_executor(
+                        None, convert_pdf_to_images_cached, filepath, digest, upload_dir
+                    )
                     saved_files.extend(pdf_images)
+                except PdfTooLargeError as e:
+                    return jsonify({'error': str(e)}), 400
                 except Exception as e:
                     logger.error(f"PDF转换失败: {e}")
                     return jsonify({'error': f'PDF处理失败: {str(e)}'}), 500
             else:
+                remove_existing(filepath)
+                await file.save(filepath)
                 saved_files.append(filepath)
     
     if not saved_files:
@@ -267,8 +740,8 @@ def upload_files():
 
 
 @app.route('/api/process', methods=['POST'])
-def process_files():
-    data = request.get_json()
+async def process_files():
+    data = await request.get_json()
     job_id = data.get('job_id')
     api_key = data.get('api_key', '').strip()
     custom_prompt = data.get('custom_prompt')
@@ -283,20 +756,20 @@ def process_files():
     if not os.path.exists(upload_dir):
         return jsonify({'error': '任务不存在'}), 404
     
-    image_files = []
-    for ext in ['*.png', '*.jpg', '*.jpeg']:
-        image_files.extend(Path(upload_dir).glob(ext))
+    with os.scandir(upload_dir) as it:
+        file_paths = [
+            e.path for e in it
+            if e.is_file() and os.path.splitext(e.name)[1].lower() in IMAGE_EXTENSIONS
+        ]
     
-    if not image_files:
+    if not file_paths:
         return jsonify({'error': '没有待处理的文件'}), 400
     
-    file_paths = [str(f) for f in image_files]
-    
     if use_custom and custom_prompt:
         processor = QwenVLProcessor(api_key, custom_prompt, format_example)
     else:
         processor = QwenVLProcessor(api_key)
-    summary = asyncio.run(processor.batch_process(file_paths, job_id))
+    summary = await processor.batch_process(file_paths, job_id)
     
     return jsonify({
         'job_id': job_id,
@@ -305,58 +778,108 @@ def process_files():
 
 
 @app.route('/api/result/<job_id>')
-def get_result(job_id):
+async def get_result(job_id):
     output_dir = os.path.join(app.config['OUTPUT_FOLDER'], job_id)
     summary_file = os.path.join(output_dir, "summary.json")
     
     if not os.path.exists(summary_file):
         return jsonify({'error': '结果不存在'}), 404
     
-    with open(summary_file, 'r', encoding='utf-8') as f:
-        summary = json.load(f)
+    with open(summary_file, 'rb') as f:
+        summary = orjson.loads(f.read())
     
     return jsonify(summary)
 
 
 @app.route('/api/download/<job_id>/<filename>')
-def download_file(job_id, filename):
+async def download_file(job_id, filename):
     output_dir = os.path.join(app.config['OUTPUT_FOLDER'], job_id)
     filepath = os.path.join(output_dir, filename)
     
     if not os.path.exists(filepath):
         return jsonify({'error': '文件不存在'}), 404
     
-    return send_file(filepath, as_attachment=True)
+    return await send_file(filepath, as_attachment=True)
+
+
+class _ZipChunkBuffer:
+    """供ZipFile写入的不可seek缓冲区，写入的数据按块取出后发送给客户端"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+
+def iter_zip(output_dir, chunk_size=1 << 20):
+    """边压缩边输出ZIP数据，内存占用与任务大小无关"""
+    buf = _ZipChunkBuffer()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for root, dirs, files in os.walk(output_dir):
+            for file in files:
+                if file == 'summary.json':
+                    continue
+                filepath = os.path.join(root, file)
+                zinfo = zipfile.ZipInfo.from_file(filepath, os.path.relpath(filepath, output_dir))
+                # 图片本身已压缩，直接存储避免重复deflate
+                if os.path.splitext(file)[1].lower() in STORED_EXTENSIONS:
+                    zinfo.compress_type = zipfile.ZIP_STORED
+                else:
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                with open(filepath, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    while chunk := src.read(chunk_size):
+                        dst.write(chunk)
+                        data = buf.pop()
+                        if data:
+                            yield data
+                data = buf.pop()
+                if data:
+                    yield data
+    yield buf.pop()
+
+
+async def aiter_zip(output_dir):
+    """在线程池中逐块生成ZIP数据，避免压缩阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    chunks = iter_zip(output_dir)
+    while (chunk := await loop.run_in_executor(None, next, chunks, None)) is not None:
+        yield chunk
 
 
 @app.route('/api/download-all/<job_id>')
-def download_all(job_id):
-    import zipfile
-    from io import BytesIO
-    
+async def download_all(job_id):
     output_dir = os.path.join(app.config['OUTPUT_FOLDER'], job_id)
     
     if not os.path.exists(output_dir):
         return jsonify({'error': '结果不存在'}), 404
     
-    memory = BytesIO()
-    
-    with zipfile.ZipFile(memory, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(output_dir):
-            for file in files:
-                if file != 'summary.json':
-                    filepath = os.path.join(root, file)
-                    arcname = os.path.relpath(filepath, output_dir)
-                    zf.write(filepath, arcname)
-    
-    memory.seek(0)
-    
-    return send_file(
-        memory,
+    response = Response(
+        aiter_zip(output_dir),
         mimetype='application/zip',
-        as_attachment=True,
-        download_name=f'results_{job_id[:8]}.zip'
+        headers={'Content-Disposition': f'attachment; filename=results_{job_id[:8]}.zip'}
     )
+    # 关闭Quart默认的RESPONSE_TIMEOUT，否则大任务的ZIP流会在超时后被静默截断
+    response.timeout = None
+    return response
+
+
+@app.after_serving
+async def shutdown():
+    await close_session()
+    shutdown_render_pool()
 
 
 if __name__ == '__main__':